@@ -1,25 +1,30 @@
 
 import streamlit as st
 import os
+import re
 import streamlit as st
 import pandas as pd
+import numpy as np
 from io import BytesIO
 from datetime import datetime
-from docx import Document
-from docx.shared import Pt
-import smtplib
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from email.mime.text import MIMEText
-from email.utils import formataddr
+# docx and SMTP/email modules are imported where they're used, so the watch/renewal
+# pages don't pay for them on every cold start.
 
 # --- Similarity helpers ---
+# score_matrix(marks, keywords) -> len(marks) x len(keywords) float32 matrix of 0-100 scores.
+# Left unrounded so the threshold compares against the true score, as the per-pair loop did.
 try:
-    from rapidfuzz.fuzz import ratio as fuzz_ratio
-    def similar(a, b):
-        try:
-            return fuzz_ratio(a or "", b or "") / 100.0
-        except Exception:
-            return 0.0
+    from rapidfuzz import process, fuzz, utils
+    # token_set_ratio ignores word order ("ACME FOODS" vs "FOODS ACME") and extra words
+    # ("SunGlo Skincare" vs "sunglo"); default_process lowercases and strips punctuation once per string.
+    def mark_process(s):
+        # Join "-", "'" and "." inside a word first ("power-max" -> "powermax"): split into separate
+        # tokens, any one-word filing ("Max") would be a token subset and score 100
+        return utils.default_process(re.sub(r"(?<=\w)[-'.](?=\w)", "", s))
+
+    def score_matrix(marks, keywords):
+        return process.cdist(marks, keywords, scorer=fuzz.token_set_ratio, processor=mark_process,
+                             dtype=np.float32, workers=-1)
     SIM_ENGINE = "RapidFuzz"
 except Exception:
     from difflib import SequenceMatcher
@@ -28,6 +33,8 @@ except Exception:
             return SequenceMatcher(None, (a or "").lower(), (b or "").lower()).ratio()
         except Exception:
             return 0.0
+    def score_matrix(marks, keywords):
+        return np.array([[similar(a, b) * 100 for b in keywords] for a in marks], dtype=np.float32).reshape(len(marks), len(keywords))
     SIM_ENGINE = "difflib"
 
 st.set_page_config(page_title="Harshita Legal AI", layout="wide")
@@ -63,6 +70,7 @@ with st.expander("About this prototype / How to use"):
 st.sidebar.header("Settings")
 lead_days = st.sidebar.number_input("Renewal lead time (days)", min_value=1, max_value=365, value=60)
 sim_threshold = st.sidebar.slider("Similarity threshold for watch", 0.0, 1.0, 0.75, 0.01)
+max_rows = st.sidebar.number_input("Max conflict rows to display", min_value=50, max_value=5000, value=500, step=50)
 
 
 
@@ -118,50 +126,64 @@ st.caption(f"SMTP defaults loaded: {'✅' if loaded else '⚠️ None found'}")
 st.header("1) Upload IP Portfolio")
 portfolio_file = st.file_uploader("Upload ip_portfolio_template.xlsx (or your own with same columns)", type=["xlsx"], key="portfolio")
 
+# Uploads are parsed once per file content; Streamlit reruns the whole script on every widget change.
+def arrow_strings(df):
+    # Arrow-backed strings (contiguous UTF-8) for isin/concat/str ops when pyarrow is installed
+    try:
+        return df.astype("string[pyarrow]")
+    except ImportError:
+        return df
+
+@st.cache_data
+def load_portfolio(file_bytes):
+    # Rust-backed calamine reader when installed; openpyxl otherwise
+    try:
+        df = pd.read_excel(BytesIO(file_bytes), dtype=str, engine="calamine").fillna("")
+    except ImportError:
+        df = pd.read_excel(BytesIO(file_bytes), dtype=str).fillna("")
+    df = arrow_strings(df)
+    for c in ["FilingDate","RegistrationDate","RenewalDate"]:
+        if c in df.columns:
+            df[c] = pd.to_datetime(df[c], errors="coerce").dt.normalize()
+    return df
+
 portfolio = None
 due = pd.DataFrame()
 if portfolio_file:
     try:
-        portfolio = pd.read_excel(portfolio_file, dtype=str).fillna("")
+        portfolio = load_portfolio(portfolio_file.getvalue())
     except Exception as e:
         st.error(f"Error reading Excel file: {e}")
         portfolio = None
 
 if portfolio is not None:
-    for c in ["FilingDate","RegistrationDate","RenewalDate"]:
-        if c in portfolio.columns:
-            portfolio[c] = pd.to_datetime(portfolio[c], errors="coerce").dt.date
     st.success(f"Loaded {len(portfolio)} records from portfolio.")
     st.dataframe(portfolio, use_container_width=True)
 
     st.subheader("Renewals due soon")
-    today = pd.to_datetime(datetime.today().date())
+    today = np.datetime64(datetime.today().date(), "D")
     if "RenewalDate" in portfolio.columns:
-        dd = portfolio.copy()
-        dd["RenewalDate"] = pd.to_datetime(dd["RenewalDate"], errors="coerce")
-        dd["DaysToRenewal"] = (dd["RenewalDate"] - today).dt.days
-        due = dd[(dd["DaysToRenewal"] >= 0) & (dd["DaysToRenewal"] <= lead_days)].sort_values("DaysToRenewal")
+        # Whole days on the raw datetime64 array; a missing date (NaT) becomes int64 min, never due
+        days = (portfolio["RenewalDate"].to_numpy() - today).astype("timedelta64[D]").astype("int64")
+        # Select the due rows first; only that slice gets the new column, never a copy of the whole portfolio
+        hit = (days >= 0) & (days <= lead_days)
+        due = portfolio.loc[hit].assign(DaysToRenewal=days[hit]).sort_values("DaysToRenewal")
         st.write(f"Found {len(due)} marks due in next {lead_days} days.")
         st.dataframe(due[["Trademark","Class","RegNo","RenewalDate","Owner","OwnerEmail","DaysToRenewal"]], use_container_width=True)
 
         if len(due):
-            msgs = []
-            for _, r in due.iterrows():
-                msg = (
-                    "Subject: Renewal reminder - {tm} (Class {cl}) due {date}\n\n"
-                    "Hello {owner},\n\n"
-                    "This is a friendly reminder that your trademark \"{tm}\" (Class {cl}, Reg. No. {reg}) is due for renewal on {date}.\n\n"
-                    "Please reply to confirm whether you'd like us to proceed with renewal formalities. If yes, we'll share the checklist and fee estimate.\n\n"
-                    "Thanks,\nHarshita Legal AI Team"
-                ).format(
-                    tm=r.get("Trademark",""),
-                    cl=r.get("Class",""),
-                    date=r.get("RenewalDate",""),
-                    owner=r.get("Owner",""),
-                    reg=r.get("RegNo","")
-                )
-                msgs.append({"Owner": r.get("Owner",""), "OwnerEmail": r.get("OwnerEmail",""), "Trademark": r.get("Trademark",""), "Message": msg})
-            msgs_df = pd.DataFrame(msgs)
+            tm = due["Trademark"].astype(str)
+            cl = due["Class"].astype(str)
+            date = due["RenewalDate"].astype(str)
+            owner = due["Owner"].astype(str)
+            reg = due["RegNo"].astype(str)
+            msgs_df = due[["Owner","OwnerEmail","Trademark"]].assign(Message=(
+                "Subject: Renewal reminder - " + tm + " (Class " + cl + ") due " + date + "\n\n"
+                "Hello " + owner + ",\n\n"
+                "This is a friendly reminder that your trademark \"" + tm + "\" (Class " + cl + ", Reg. No. " + reg + ") is due for renewal on " + date + ".\n\n"
+                "Please reply to confirm whether you'd like us to proceed with renewal formalities. If yes, we'll share the checklist and fee estimate.\n\n"
+                "Thanks,\nHarshita Legal AI Team"
+            ))
             st.download_button("Download reminder emails (CSV)", data=msgs_df.to_csv(index=False), file_name=f"renewal_reminders_result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv", mime="text/csv")
 
             with st.expander("Optional: Send reminder emails now (SMTP)"):
@@ -177,25 +199,74 @@ if portfolio is not None:
                     options=list(due.index),
                     format_func=lambda i: f"{due.loc[i,'Trademark']} (due {due.loc[i,'RenewalDate']})"
                 )
+                workers = st.number_input("Concurrent SMTP connections", min_value=1, max_value=15, value=3, step=1)
                 send_click = st.button("Send selected reminders")
 
-                def send_mail(server, port, user, pwd, from_name, from_email, to_email, subject, body):
+                def open_smtp(server, port, user, pwd):
+                    s = smtplib.SMTP(server, port)
+                    s.starttls()
+                    s.login(user, pwd)
+                    return s
+
+                def smtp_alive(s):
+                    try:
+                        return s.noop()[0] == 250
+                    except smtplib.SMTPException:
+                        return False
+
+                def close_smtp(s):
+                    try:
+                        s.quit()
+                    except Exception:
+                        s.close()
+
+                def send_mail(s, from_name, from_email, to_email, subject, body):
                     msg = MIMEText(body, "plain")
                     msg["Subject"] = subject
                     msg["From"] = formataddr((from_name, from_email))
                     msg["To"] = to_email
-                    with smtplib.SMTP(server, port) as s:
-                        s.starttls()
-                        s.login(user, pwd)
-                        s.sendmail(from_email, [to_email], msg.as_string())
+                    s.sendmail(from_email, [to_email], msg.as_string())
+
+                # Only a session idle this long gets a NOOP before use; one that just sent is trusted as-is
+                SMTP_IDLE_CHECK_S = 30
+
+                def send_pooled(pool, to_email, subject, body):
+                    # Borrow a (session, last used) slot from the pool (None = not connected yet) and always hand one back
+                    s, last_used = pool.get()
+                    try:
+                        # The server may have closed a session that sat idle; check those with a NOOP before use.
+                        # No retry after sendmail, since a drop while awaiting the DATA reply may
+                        # come after the server accepted the message and would send a duplicate.
+                        if s is not None and time.monotonic() - last_used > SMTP_IDLE_CHECK_S and not smtp_alive(s):
+                            s.close()
+                            s = None
+                        if s is None:
+                            s = open_smtp(smtp_server, smtp_port, smtp_user, smtp_pass)
+                        send_mail(s, from_name, from_email, to_email, subject, body)
+                    except Exception:
+                        # Drop the session if the failure took it down; the slot reconnects on next use
+                        if s is not None and not smtp_alive(s):
+                            s.close()
+                            s = None
+                        raise
+                    finally:
+                        pool.put((s, time.monotonic()))
 
                 if send_click:
+                    import smtplib
+                    import queue
+                    import time
+                    from concurrent.futures import ThreadPoolExecutor, as_completed
+                    from email.mime.text import MIMEText
+                    from email.utils import formataddr
+
                     if not (smtp_server and smtp_user and smtp_pass and from_email):
                         st.error("Please fill SMTP settings.")
                     elif not sel:
                         st.warning("Please select at least one mark to email.")
                     else:
                         success, fail = 0, 0
+                        jobs = []
                         for i in sel:
                             r = due.loc[i]
                             body_lines = msgs_df[msgs_df["Trademark"] == r.get("Trademark","")]["Message"]
@@ -205,12 +276,55 @@ if portfolio is not None:
                             if not to_email:
                                 fail += 1
                                 continue
-                            try:
-                                send_mail(smtp_server, smtp_port, smtp_user, smtp_pass, from_name, from_email, to_email, subject, body)
-                                success += 1
-                            except Exception as e:
-                                st.write(f"Error sending to {to_email}: {e}")
-                                fail += 1
+                            jobs.append((to_email, subject, body))
+
+                        # A small pool of persistent sessions (TLS + login once each) shared by worker threads.
+                        # The first one is opened up front so bad settings fail once, not once per email.
+                        pool = queue.Queue()
+                        try:
+                            pool.put((open_smtp(smtp_server, smtp_port, smtp_user, smtp_pass), time.monotonic()))
+                        except Exception as e:
+                            st.error(f"SMTP connection failed: {e}")
+                            fail += len(jobs)
+                            jobs = []
+                        if jobs:
+                            n = min(int(workers), len(jobs))
+                            for _ in range(n - 1):
+                                pool.put((None, 0.0))
+                            # Give up once failures pile up (bad credentials, rate limiting) instead of hammering the server
+                            max_fail = max(10, len(sel) // 3)
+                            last_err = None
+                            with ThreadPoolExecutor(max_workers=n) as ex:
+                                futures = {ex.submit(send_pooled, pool, *job): job[0] for job in jobs}
+                                pending = set(futures)
+                                for fut in as_completed(futures):
+                                    pending.discard(fut)
+                                    try:
+                                        fut.result()
+                                        success += 1
+                                    except Exception as e:
+                                        st.write(f"Error sending to {futures[fut]}: {e}")
+                                        fail += 1
+                                        last_err = e
+                                        if fail > max_fail:
+                                            for f in pending:
+                                                f.cancel()
+                                            break
+                            # Sends already in flight when we stopped still finish; cancelled ones were never attempted
+                            skipped = sum(f.cancelled() for f in pending)
+                            for f in pending:
+                                if not f.cancelled():
+                                    if f.exception() is None:
+                                        success += 1
+                                    else:
+                                        fail += 1
+                            if skipped:
+                                fail += skipped
+                                st.error(f"Stopped sending after repeated failures; {skipped} reminder(s) not attempted. Last error: {last_err}")
+                        while not pool.empty():
+                            s, _ = pool.get()
+                            if s is not None:
+                                close_smtp(s)
                         st.success(f"Emails sent: {success}, failed: {fail}")
 
 
@@ -218,50 +332,96 @@ if portfolio is not None:
 st.header("2) Trademark Watch (Prototype)")
 filings_file = st.file_uploader("Upload new filings CSV (e.g., new_tm_filings_20rows.csv)", type=["csv"], key="filings")
 
-def base_row_style(row):
-    sim = row.get("Similarity", 0)
-    if sim >= 0.9:
-        return ["background-color: #ffd6d6"] * len(row)  # light red
-    elif sim >= 0.8:
-        return ["background-color: #ffe8cc"] * len(row)  # light orange
-    elif sim >= 0.7:
-        return ["background-color: #fff6bf"] * len(row)  # light yellow
-    return [""] * len(row)
-
 def highlight_keyword_col(col_series):
     return ['background-color: #fff176; font-weight: bold; border: 1px solid #f1c40f' for _ in col_series]
 
-if (portfolio is not None) and filings_file:
-    filings = pd.read_csv(filings_file, dtype=str).fillna("")
-    st.success(f"Loaded {len(filings)} new filings.")
-    watchwords = []
+def style_conflicts(df):
+    # Row colour by Similarity, computed for the whole frame at once rather than per row
+    sim = df["Similarity"].to_numpy()
+    color = np.select(
+        [sim >= 0.9, sim >= 0.8, sim >= 0.7],
+        ["background-color: #ffd6d6",   # light red
+         "background-color: #ffe8cc",   # light orange
+         "background-color: #fff6bf"],  # light yellow
+        default="",
+    )
+    # One colour per row spread across the columns (the DataFrame still copies it into object columns)
+    css = pd.DataFrame(np.broadcast_to(color[:, None], df.shape), index=df.index, columns=df.columns)
+    return df.style.apply(lambda _: css, axis=None).apply(highlight_keyword_col, subset=["MatchedKeyword"])
+
+ALERT_COLS = ["FilingDate","Mark","Class","Applicant","ApplicationNo"]
+
+@st.cache_data
+def load_filings(file_bytes):
+    df = pd.read_csv(BytesIO(file_bytes), dtype=str).fillna("")
+    for c in ALERT_COLS:
+        if c not in df.columns:
+            df[c] = ""
+    return arrow_strings(df)
+
+@st.cache_data
+def watch_keywords(portfolio_bytes):
+    # Watch keywords, deduped on their lowercased form and bucketed by the portfolio class they protect
+    # (all under "" if the portfolio has no Class column): {class: {lowercased: keyword as first written}}.
+    portfolio = load_portfolio(portfolio_bytes)
+    port_cls = portfolio["Class"].astype(str) if "Class" in portfolio.columns else pd.Series("", index=portfolio.index)
+    watch_by_class = {}
     if "WatchKeywords" in portfolio.columns:
-        for w in portfolio["WatchKeywords"].dropna().astype(str):
-            watchwords.extend([x.strip() for x in str(w).split(";") if x.strip()])
-    st.write("Watch keywords:", ", ".join(sorted(set(watchwords))[:100]))
+        for cl, w in zip(port_cls, portfolio["WatchKeywords"].astype(str)):
+            bucket = watch_by_class.setdefault(cl, {})
+            for x in w.split(";"):
+                if x.strip():
+                    bucket.setdefault(x.strip().lower(), x.strip())
+    return {cl: dict(sorted(words.items())) for cl, words in watch_by_class.items()}
+
+@st.cache_data
+def score_buckets(portfolio_bytes, filings_bytes):
+    # A filing is only scored against keywords of its own class, one batch per class bucket.
+    # Scores don't depend on the threshold, so moving the slider only re-masks them.
+    # Returns the (class-filtered, deduplicated) filings and [(row positions, display keywords, scores), ...].
+    watch_by_class = watch_keywords(portfolio_bytes)
+    by_class = "Class" in load_portfolio(portfolio_bytes).columns
+    filings = load_filings(filings_bytes)
+    if by_class:
+        filings = filings.loc[filings["Class"].isin(frozenset(watch_by_class))]
+    # Repeated filings would only produce repeated alerts
+    filings = filings.drop_duplicates(subset=ALERT_COLS).reset_index(drop=True)
+    filing_cls = filings["Class"] if by_class else pd.Series("", index=filings.index)
+
+    marks = filings["Mark"].to_numpy()
+    buckets = []
+    for cl, pos in filings.groupby(filing_cls, sort=False).indices.items():
+        kw = watch_by_class.get(cl)
+        if kw:
+            # Same mark filed more than once in a class (other applicant / app no.): score it once
+            uniq, inv = np.unique(marks[pos], return_inverse=True)
+            buckets.append((pos, np.asarray(list(kw.values()), dtype=object), score_matrix(uniq.tolist(), list(kw))[inv]))
+    return filings, buckets
+
+def find_conflicts(portfolio_bytes, filings_bytes, cutoff):
+    filings, buckets = score_buckets(portfolio_bytes, filings_bytes)
+    rows, kws, sims = [], [], []
+    for pos, kw, scores in buckets:
+        ii, jj = np.nonzero(scores >= cutoff)
+        rows.append(pos[ii])
+        kws.append(kw[jj])
+        sims.append(scores[ii, jj])
+    if not rows:
+        return pd.DataFrame()
+    # One frame straight from the hit index arrays; (filing, keyword) pairs are unique by construction
+    hits = filings.iloc[np.concatenate(rows)]
+    alerts = {c: hits[c].to_numpy() for c in ALERT_COLS}
+    alerts["MatchedKeyword"] = np.concatenate(kws)
+    alerts["Similarity"] = np.round(np.concatenate(sims) / 100.0, 3)
+    return pd.DataFrame(alerts)
 
-    classes_in_portfolio = set(portfolio["Class"].astype(str).tolist()) if "Class" in portfolio.columns else set()
+if (portfolio is not None) and filings_file:
+    filings = load_filings(filings_file.getvalue())
+    st.success(f"Loaded {len(filings)} new filings.")
+    watch_by_class = watch_keywords(portfolio_file.getvalue())
+    st.write("Watch keywords:", ", ".join(sorted({w for kw in watch_by_class.values() for w in kw.values()})[:100]))
 
-    alerts = []
-    for _, f in filings.iterrows():
-        mark = f.get("Mark","")
-        cl = str(f.get("Class",""))
-        if classes_in_portfolio and cl not in classes_in_portfolio:
-            continue
-        for w in watchwords:
-            score = similar(mark, w)
-            if score >= sim_threshold:
-                alerts.append({
-                    "FilingDate": f.get("FilingDate",""),
-                    "Mark": mark,
-                    "Class": cl,
-                    "Applicant": f.get("Applicant",""),
-                    "ApplicationNo": f.get("ApplicationNo",""),
-                    "MatchedKeyword": w,
-                    "Similarity": round(score, 3)
-                })
-
-    alerts_df = pd.DataFrame(alerts).drop_duplicates()
+    alerts_df = find_conflicts(portfolio_file.getvalue(), filings_file.getvalue(), sim_threshold * 100)
     st.subheader("Potential conflicts")
 
     if len(alerts_df):
@@ -273,37 +433,50 @@ if (portfolio is not None) and filings_file:
         with filter_col2:
             search_text = st.text_input("Search Mark / Applicant / App No.", "").strip().lower()
 
-        filt = alerts_df.copy()
+        # One combined mask, one selection from alerts_df
+        keep = np.ones(len(alerts_df), dtype=bool)
         if selected_classes:
-            filt = filt[filt["Class"].astype(str).isin(selected_classes)]
+            keep &= alerts_df["Class"].astype(str).isin(selected_classes).to_numpy(dtype=bool)
         if search_text:
-            mask = (
-                filt["Mark"].str.lower().str.contains(search_text) |
-                filt["Applicant"].str.lower().str.contains(search_text) |
-                filt["ApplicationNo"].str.lower().str.contains(search_text)
-            )
-            filt = filt[mask]
+            # Plain substring match: no regex compile, and special characters in the query ("(", "+") are literal
+            mask = np.zeros(len(alerts_df), dtype=bool)
+            for c in ["Mark","Applicant","ApplicationNo"]:
+                mask |= alerts_df[c].str.lower().str.contains(search_text, regex=False, na=False).to_numpy(dtype=bool)
+            keep &= mask
+        filt = alerts_df.loc[keep]
 
         filt = filt.sort_values("Similarity", ascending=False)
 
         # --- Export to Excel: one sheet per class + All_Alerts
         def export_per_class_excel(df):
+            # xlsxwriter in constant_memory mode flushes each row to disk as it's written. pandas' to_excel
+            # writes column by column, which that mode can't handle, so rows are written directly.
+            import xlsxwriter
+
             bio = BytesIO()
-            with pd.ExcelWriter(bio, engine="xlsxwriter") as writer:
-                # All alerts sheet
-                df.to_excel(writer, sheet_name="All_Alerts", index=False)
-                # Per-class sheets
-                for cl, g in df.groupby(df["Class"].astype(str)):
-                    sheet_name = f"Class_{cl}"
-                    g.to_excel(writer, sheet_name=sheet_name, index=False)
-            bio.seek(0)
+            wb = xlsxwriter.Workbook(bio, {"constant_memory": True})
+            header_fmt = wb.add_format({"bold": True, "border": 1})
+
+            def write_sheet(name, g):
+                ws = wb.add_worksheet(name)
+                ws.write_row(0, 0, list(g.columns), header_fmt)
+                for i, row in enumerate(g.itertuples(index=False, name=None), start=1):
+                    ws.write_row(i, 0, row)
+
+            # All alerts sheet
+            write_sheet("All_Alerts", df)
+            # Per-class sheets
+            for cl, g in df.groupby(df["Class"].astype(str)):
+                write_sheet(f"Class_{cl}", g)
+            wb.close()
             return bio.getvalue()
 
         excel_bytes = export_per_class_excel(filt)
 
-        # Styling for on-screen table
-        styled = filt.style.apply(base_row_style, axis=1).apply(highlight_keyword_col, subset=["MatchedKeyword"])
-        st.dataframe(styled, use_container_width=True)
+        # Styling for on-screen table; only the top rows are rendered, exports keep everything
+        st.dataframe(style_conflicts(filt.head(max_rows)), use_container_width=True)
+        if len(filt) > max_rows:
+            st.caption(f"Showing top {max_rows} of {len(filt)} conflicts by similarity. Downloads include all rows.")
 
         dl_col1, dl_col2 = st.columns([1,1])
         with dl_col1:
@@ -339,20 +512,87 @@ with st.form("license_form_v2"):
 
     submitted = st.form_submit_button("Generate Agreement (.docx)")
 
-if submitted:
+# Template bytes are read once per server process; each submission parses a fresh copy.
+# A miss raises instead of returning None, so it isn't cached and the next submission looks again.
+@st.cache_resource
+def load_template_bytes():
     template_candidates = [
         "TM_License_Template_Placeholders.docx",
         "./TM_License_Template_Placeholders.docx",
         "/mnt/data/TM_License_Template_Placeholders.docx",
     ]
-    doc = None
     for p in template_candidates:
         try:
-            doc = Document(p)
-            break
+            with open(p, "rb") as f:
+                return f.read()
         except Exception:
             continue
-    if doc is None:
+    raise FileNotFoundError("TM_License_Template_Placeholders.docx")
+
+if submitted:
+    from docx import Document
+    from docx.shared import Pt
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+    try:
+        from docxtpl import DocxTemplate
+        from jinja2 import Environment, StrictUndefined, TemplateError
+    except ImportError:
+        DocxTemplate = None
+
+    try:
+        tpl = load_template_bytes()
+    except FileNotFoundError:
+        tpl = None
+
+    repl = {
+        "{{LicensorName}}": licensor,
+        "{{LicensorAddress}}": licensor_addr,
+        "{{LicenseeName}}": licensee,
+        "{{LicenseeAddress}}": licensee_addr,
+        "{{Trademark}}": trademark,
+        "{{Class}}": clss,
+        "{{Territory}}": territory,
+        "{{LicenseType}}": lic_type,
+        "{{EffectiveDate}}": eff,
+        "{{TermYears}}": term,
+        "{{RoyaltyPercent}}": royalty,
+        "{{GoverningLaw}}": law,
+        "{{ArbitrationSeat}}": seat,
+    }
+
+    # Placeholder name -> value; one compiled alternation gives a single regex pass per run instead of one scan per key
+    mapping = {k.strip("{}"): str(v) for k, v in repl.items()}
+    pat = re.compile(r"\{\{(" + "|".join(map(re.escape, mapping)) + r")\}\}")
+
+    def fill(text):
+        return pat.sub(lambda m: mapping[m.group(1)], text)
+
+    def fill_paragraph(p):
+        if "{{" not in p.text:
+            return
+        for run in p.runs:
+            run.text = fill(run.text)
+        # A placeholder split across runs survives the per-run pass; collapse the text into the first run
+        if p.runs and pat.search(p.text):
+            p.runs[0].text = fill(p.text)
+            for run in p.runs[1:]:
+                run.text = ""
+
+    # docxtpl renders every placeholder in body, tables, headers and footers in one Jinja pass
+    tpl_doc = None
+    if tpl and DocxTemplate:
+        tpl_doc = DocxTemplate(BytesIO(tpl))
+        try:
+            # StrictUndefined: a template placeholder the form doesn't supply raises instead of rendering as "";
+            # autoescape keeps '&' or '<' in party names from corrupting the document XML
+            tpl_doc.render(mapping, jinja_env=Environment(undefined=StrictUndefined), autoescape=True)
+        except TemplateError:
+            # Unknown name, "{{Licensor Name}}" or a stray "{%": fall back to the literal fill,
+            # which leaves anything it doesn't know visible in the agreement
+            tpl_doc = None
+    doc = tpl_doc.docx if tpl_doc else (Document(BytesIO(tpl)) if tpl else Document())
+    if not tpl:
         # Title
         title_para = doc.add_paragraph()
         title_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
@@ -408,39 +648,17 @@ if submitted:
         p1.alignment = WD_ALIGN_PARAGRAPH.CENTER
 
 
-    repl = {
-        "{{LicensorName}}": licensor,
-        "{{LicensorAddress}}": licensor_addr,
-        "{{LicenseeName}}": licensee,
-        "{{LicenseeAddress}}": licensee_addr,
-        "{{Trademark}}": trademark,
-        "{{Class}}": clss,
-        "{{Territory}}": territory,
-        "{{LicenseType}}": lic_type,
-        "{{EffectiveDate}}": eff,
-        "{{TermYears}}": term,
-        "{{RoyaltyPercent}}": royalty,
-        "{{GoverningLaw}}": law,
-        "{{ArbitrationSeat}}": seat,
-    }
-
-    for p in doc.paragraphs:
-        for k, v in repl.items():
-            if k in p.text:
-                for run in p.runs:
-                    run.text = run.text.replace(k, str(v))
-
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for k, v in repl.items():
-                    if k in cell.text:
-                        for para in cell.paragraphs:
-                            for run in para.runs:
-                                run.text = run.text.replace(k, str(v))
-
     bio = BytesIO()
-    doc.save(bio)
+    if tpl_doc:
+        tpl_doc.save(bio)
+    else:
+        # Body and table-cell paragraphs in one flat traversal
+        paragraphs = list(doc.paragraphs) + [
+            para for table in doc.tables for row in table.rows for cell in row.cells for para in cell.paragraphs
+        ]
+        for p in paragraphs:
+            fill_paragraph(p)
+        doc.save(bio)
     st.session_state["license_doc"] = bio.getvalue()
 
 if "license_doc" in st.session_state: